@@ -1,5 +1,5 @@
 from etutils.asciiart import asciiart
-from etutils.ismember import ismember
+from etutils.ismember import ismember, IsMemberIndex
 from etutils.time_extract import time_extract
 from etutils.time_diff import time_diff
 from etutils.strdiff import strdiff
@@ -12,7 +12,7 @@ from etutils.list2flatten import list2flatten
 from etutils.internet_status import internet_status
 from etutils.dummyvar import dummyvar
 from etutils.dict2flatten import dict2flatten
-from etutils.df2onehot import df2onehot
+from etutils.df2onehot import df2onehot, DF2OneHotEncoder
 from etutils.colormap import colormap
 
 # Import function in new level
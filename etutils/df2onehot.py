@@ -3,12 +3,24 @@
    from etutils.df2onehot import df2onehot
 
  EXAMPLE
+    import numpy as np
     import pandas as pd
     nfeat=100
     nobservations=50
     df = pd.DataFrame(np.random.randint(0,2,(nfeat,nobservations)))
     A = df2onehot(df)
 
+    # Benchmark
+    from etutils.tictoc import tic, toc
+    df = pd.DataFrame(np.random.randint(0,50,(1000000,200))).astype(str)
+    df.columns = df.columns.astype(str)
+    tic(); A = df2onehot(df, verbose=0); print(toc())
+
+    # Fit once, transform new batches with the same columns
+    from etutils.df2onehot import DF2OneHotEncoder
+    enc = DF2OneHotEncoder().fit(df)
+    A = enc.transform(df.iloc[0:1000,:])
+
 
  -----------------------------------
   Name        : df2onehot.py
@@ -19,17 +31,17 @@
 """
 
 #%% Libraries
+import os
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import LabelEncoder
-from sklearn.preprocessing import OneHotEncoder
+import scipy.sparse as sp
 # Custom
-from etutils.set_dtypes import set_dtypes
-label_encoder = LabelEncoder()
-onehot_encoder = OneHotEncoder(sparse=False, categories='auto')
+from etutils.set_dtypes import set_dtypes, auto_dtypes, set_types
 
 #%% My function
-def df2onehot(df, dtypes='pandas', hot_only=True, y_min=None, list_expand=True, perc_min_num=None, excl_background=None, verbose=3):
+def df2onehot(df, dtypes='pandas', hot_only=True, y_min=None, list_expand=True, perc_min_num=None, excl_background=None, sparse=False, n_jobs=1, cache=False, verbose=3):
     '''
                    
     Parameters
@@ -55,6 +67,15 @@ def df2onehot(df, dtypes='pandas', hot_only=True, y_min=None, list_expand=True,
         None (default)
         [0]
         [0, '0.0', 'male', ...]
+    sparse : Bool, Keep the one-hot columns sparse (pandas sparse boolean columns). The one-hot matrix is never densified.
+        False (default)
+        True
+    n_jobs : Integer, Number of processes to encode the columns. Results are combined in the original column order.
+        1 (default)
+        -1: all cores
+    cache : Bool, Reuse the dtypes of columns that were detected before (see set_dtypes), so that repeated calls on the same columns skip the dtype detection.
+        False (default)
+        True
     verbose : Integer, [0..5] if verbose >= DEBUG: print('debug message')
         0: (default)
         1: ERROR
@@ -76,57 +97,33 @@ def df2onehot(df, dtypes='pandas', hot_only=True, y_min=None, list_expand=True,
     labx=[]
     
     # Determine Dtypes
-    [df, dtypes] = set_dtypes(df, config['dtypes'], is_list=config['list_expand'], perc_min_num=config['perc_min_num'], verbose=config['verbose'])
+    [df, dtypes] = set_dtypes(df, config['dtypes'], is_list=config['list_expand'], perc_min_num=config['perc_min_num'], cache=cache, verbose=config['verbose'])
     # If any column is a list, also expand the list!
-    [df, dtypes]=expand_column_with_list(df, dtypes, config['verbose'])
-    
-    # Make empty frames
-    out_numeric=pd.DataFrame()
-    out_onehot=pd.DataFrame()
+    [df, dtypes]=expand_column_with_list(df, dtypes, sparse=sparse, verbose=config['verbose'])
     
-    # Run over all columns
-    for i in np.arange(0,df.shape[1]):
-        if verbose>=3: print('[DF2ONEHOT] Working on %s' %(df.columns[i]), end='')
-        
-        # Do not touch a float
-        if 'float' in str(df.dtypes[i]):
-            if verbose>=3: print('')
-            out_numeric[df.columns[i]] = df.iloc[:,i]
-            if hot_only==False:
-                out_onehot[df.columns[i]] = df.iloc[:,i]
-                labx.append(df.columns[i])
-        else:
-            integer_encoded = label_encoder.fit_transform(df.iloc[:,i])
-            # integer_encoded = set_y(integer_encoded, y_min=y_min, numeric=True, verbose=0)
+    # Encode each column once
+    encode = partial(_encode_column, hot_only=hot_only, y_min=y_min, excl_background=config['excl_background'], sparse=sparse)
+    is_float = ['float' in str(dtype) for dtype in df.dtypes]
+    columns = (df.iloc[:,i] for i in range(df.shape[1]))
+    if n_jobs==1:
+        out_cols = list(map(encode, df.columns, columns, is_float))
+    else:
+        n_jobs = os.cpu_count() if n_jobs<=0 else n_jobs
+        if verbose>=3: print('[DF2ONEHOT] Encode %d columns using %d processes' %(df.shape[1], n_jobs))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            out_cols = list(executor.map(encode, df.columns, columns, is_float, chunksize=max(1, df.shape[1]//(4*n_jobs))))
 
-            out_numeric[df.columns[i]] = integer_encoded
-            out_numeric[df.columns[i]] = out_numeric[df.columns[i]].astype('category')
-            if verbose>=3: print('.....[%.0f]' %(len(np.unique(integer_encoded))))
+    numeric=[]
+    onehot=[]
+    for colname, out_col in zip(df.columns, out_cols):
+        if verbose>=3: print('[DF2ONEHOT] Working on %s' %(colname) + ('' if out_col['nunique'] is None else '.....[%.0f]' %(out_col['nunique'])))
+        numeric.append(out_col['numeric'])
+        onehot.append(out_col)
+        labx = labx + out_col['labx']
 
-            # Contains a single value
-            if len(np.unique(integer_encoded))<=1:
-                out_onehot[df.columns[i]] = integer_encoded.astype('Bool')
-                labx.append(df.columns[i])
-            else:
-                # binary encode
-                onehot_encoded = onehot_encoder.fit_transform(integer_encoded.reshape(-1, 1))
-                # Remove columns if it does not fullfill minimum nr. of samples (>=y_min)
-                if not isinstance(y_min, type(None)):
-                    onehot_encoded=onehot_encoded[:,onehot_encoded.sum(axis=0)>=y_min]
-                # Make new one-hot columns
-                for k in range(0,onehot_encoded.shape[1]):
-                    # Get the colname based on the value in the orignal dataframe
-                    label=df.iloc[onehot_encoded[:,k]==1,i].unique().astype(str)[0]
-                    
-                    # Check whether this is a label that should be excluded.
-                    if (isinstance(config['excl_background'], type(None))) or (not np.isin(label, config['excl_background'])):
-                        colname=df.columns[i]+'_'+label
-                        out_onehot[colname] = onehot_encoded[:,k].astype('Bool')
-                        labx.append(df.columns[i])
-
-                # Make numerical vector
-                if onehot_encoded.shape[1]>2:
-                    out_numeric[df.columns[i]] =(onehot_encoded*np.arange(1,onehot_encoded.shape[1]+1)).sum(axis=1)
+    # Combine all columns at once
+    out_numeric = pd.DataFrame(dict(zip(df.columns, numeric)), index=df.index)
+    out_onehot = _combine_onehot(onehot, df.index, sparse)
     
     out=dict()
     out['numeric'] = out_numeric
@@ -136,38 +133,250 @@ def df2onehot(df, dtypes='pandas', hot_only=True, y_min=None, list_expand=True,
     
     return(out)
 
+#%% Encoder with a fitted vocabulary
+class DF2OneHotEncoder:
+    '''One-hot encoder that learns the dtypes and the labels of each column once.
+
+    The dtypes are detected on the first batch. The labels and their counts are gathered over all batches that are given to
+    partial_fit, and the y_min and excl_background decisions are made on these counts. A new batch is then transformed in
+    O(rows) without detecting the dtypes again. Labels that were not seen during fitting result in rows without hot values.
+
+    Parameters
+    ----------
+    See df2onehot.
+
+    Examples
+    --------
+    >>> enc = DF2OneHotEncoder(y_min=5).fit(df_train)
+    >>> out = enc.transform(df_new)
+    >>> # Fit over batches that do not fit in memory at once
+    >>> enc = DF2OneHotEncoder()
+    >>> for df_batch in batches: enc.partial_fit(df_batch)
+
+    '''
+    def __init__(self, dtypes='pandas', hot_only=True, y_min=None, list_expand=True, perc_min_num=None, excl_background=None, sparse=False, cache=False, verbose=3):
+        self.config = dict()
+        self.config['dtypes'] = dtypes
+        self.config['hot_only'] = hot_only
+        self.config['y_min'] = y_min
+        self.config['list_expand'] = list_expand
+        self.config['perc_min_num'] = perc_min_num
+        self.config['excl_background'] = excl_background
+        self.config['sparse'] = sparse
+        self.config['cache'] = cache
+        self.config['verbose'] = verbose
+        self.dtypes_ = None
+
+    def fit(self, df):
+        '''Learn the dtypes and labels of df. Previously fitted results are discarded.'''
+        self.dtypes_ = None
+        return(self.partial_fit(df))
+
+    def partial_fit(self, df):
+        '''Update the labels and counts with a new batch. The dtypes are detected on the first batch only.'''
+        if self.dtypes_ is None:
+            self.dtypes_ = auto_dtypes(df, self.config['dtypes'], is_list=self.config['list_expand'], perc_min_num=self.config['perc_min_num'], cache=self.config['cache'], verbose=self.config['verbose'])
+            self.columns_ = df.columns.copy()
+            self.elements_ = {col: np.array([], dtype=str) for col, dtype in zip(df.columns, self.dtypes_) if dtype=='list'}
+            self.counts_ = dict()
+            self.n_samples_ = 0
+        assert df.columns.equals(self.columns_), 'Columns in df do not match the fitted columns'
+
+        # Grow the elements of the list columns
+        for col in self.elements_.keys():
+            self.elements_[col] = np.union1d(self.elements_[col], _explode_lists(df[col])[1])
+        [df, dtypes] = self._prepare(df)
+
+        # Count the labels. An element that is new in a list column was absent in all previous rows.
+        for col, dtype in zip(df.columns, dtypes):
+            if dtype=='num': continue
+            counts = df[col].value_counts(sort=False)
+            if col not in self.counts_:
+                self.counts_[col] = pd.Series({'False': self.n_samples_}) if self.n_samples_>0 else pd.Series(dtype=int)
+            self.counts_[col] = self.counts_[col].add(counts, fill_value=0).sort_index()
+        self.n_samples_ = self.n_samples_ + df.shape[0]
+        if self.config['verbose']>=3: print('[DF2ONEHOT] Fitted on %d samples' %(self.n_samples_))
+        return(self)
+
+    def transform(self, df):
+        '''Transform df with the fitted dtypes and labels. The output is the same as df2onehot.'''
+        assert self.dtypes_ is not None, 'Encoder is not fitted yet'
+        [df, dtypes] = self._prepare(df)
+
+        out_cols = []
+        for col, dtype in zip(df.columns, dtypes):
+            if dtype=='num':
+                out_cols.append(_encode_float(col, df[col].values, hot_only=self.config['hot_only']))
+            else:
+                labels = self.counts_[col].index
+                codes = labels.get_indexer(df[col].values)
+                out_cols.append(_encode_codes(col, codes, labels.values.astype(str), self.counts_[col].values, hot_only=self.config['hot_only'], y_min=self.config['y_min'], excl_background=self.config['excl_background'], sparse=self.config['sparse']))
+
+        out=dict()
+        out['numeric'] = pd.DataFrame(dict(zip(df.columns, [out_col['numeric'] for out_col in out_cols])), index=df.index)
+        out['onehot']  = _combine_onehot(out_cols, df.index, self.config['sparse'])
+        out['labx']    = np.array(sum([out_col['labx'] for out_col in out_cols], []), dtype=str)
+        out['dtypes']  = np.array(dtypes)
+        return(out)
+
+    def fit_transform(self, df):
+        return(self.fit(df).transform(df))
+
+    def _prepare(self, df):
+        # Set the fitted dtypes and expand the list columns with the fitted elements
+        df = set_types(df.copy(), self.dtypes_, verbose=0)
+        Icol = np.isin(self.dtypes_, 'list')
+        dtypes = list(np.array(self.dtypes_)[~Icol])
+        if np.any(Icol):
+            frames = [df.loc[:, ~Icol]]
+            for col in df.columns[Icol]:
+                frames.append(pd.DataFrame(_bool2str(_list2onehot(df[col], self.elements_[col])[0]), columns=self.elements_[col], index=df.index))
+                dtypes = dtypes + ['cat']*len(self.elements_[col])
+            df = pd.concat(frames, axis=1)
+        return(df, dtypes)
+
+#%% Encode a single column
+def _encode_column(colname, values, is_float, hot_only=True, y_min=None, excl_background=None, sparse=False):
+    # Do not touch a float
+    if is_float:
+        return(_encode_float(colname, values.values, hot_only=hot_only))
+
+    # Integer codes of the sorted unique values. A sparse column (expanded list) is made dense for this column only.
+    if isinstance(values.dtype, pd.SparseDtype):
+        values = values.sparse.to_dense()
+    [codes, uniques] = pd.factorize(values, sort=True)
+    counts = None if isinstance(y_min, type(None)) else np.bincount(codes, minlength=len(uniques))
+    return(_encode_codes(colname, codes, np.asarray(uniques).astype(str), counts, hot_only=hot_only, y_min=y_min, excl_background=excl_background, sparse=sparse))
+
+#%% Encode a float column
+def _encode_float(colname, values, hot_only=True):
+    out = {'numeric': values, 'onehot': None, 'names': [], 'labx': [], 'nunique': None}
+    if hot_only==False:
+        out['onehot'] = values.reshape(-1,1)
+        out['names'] = [colname]
+        out['labx'] = [colname]
+    return(out)
+
+#%% Encode the integer codes of a column. Code -1 (unknown label) results in a row without hot values.
+def _encode_codes(colname, codes, labels, counts=None, hot_only=True, y_min=None, excl_background=None, sparse=False):
+    out = {'numeric': None, 'onehot': None, 'names': [], 'labx': [], 'nunique': len(labels)}
+    out['numeric'] = pd.Categorical.from_codes(codes, categories=np.arange(len(labels)))
+
+    # Contains a single value
+    if len(labels)<=1:
+        out['onehot'] = np.zeros((len(codes),1), dtype=bool)
+        out['names'] = [colname]
+        out['labx'] = [colname]
+        return(out)
+
+    # Remove columns if it does not fullfill minimum nr. of samples (>=y_min)
+    keep = np.ones(len(labels), dtype=bool)
+    if not isinstance(y_min, type(None)):
+        keep = counts>=y_min
+    # Make numerical vector: position of the code in the remaining columns, 0 if removed. The extra last element is used for code -1.
+    if np.sum(keep)>2:
+        rank = np.zeros(len(labels)+1)
+        rank[:-1][keep] = np.arange(1, np.sum(keep)+1)
+        out['numeric'] = rank[codes]
+
+    # Check whether this is a label that should be excluded.
+    if not isinstance(excl_background, type(None)):
+        keep = keep & ~np.isin(labels, excl_background)
+    keep = np.flatnonzero(keep)
+
+    # Make new one-hot columns
+    out['names'] = [colname+'_'+label for label in labels[keep]]
+    out['labx'] = [colname]*len(keep)
+    if sparse:
+        col = np.full(len(labels)+1, -1)
+        col[keep] = np.arange(len(keep))
+        rows = np.flatnonzero(col[codes]>=0)
+        out['onehot'] = sp.csc_matrix((np.ones(len(rows), dtype=bool), (rows, col[codes[rows]])), shape=(len(codes), len(keep)))
+    else:
+        out['onehot'] = codes[:,None]==keep[None,:]
+    return(out)
+
+#%% Combine the one-hot blocks of all columns
+def _combine_onehot(onehot, index, sparse=False):
+    onehot = [out for out in onehot if out['onehot'] is not None]
+    if len(onehot)==0:
+        return(pd.DataFrame(index=index))
+    names = sum([out['names'] for out in onehot], [])
+
+    # A single allocation if all blocks are dense booleans
+    if (not sparse) and all([out['onehot'].dtype==bool for out in onehot]):
+        return(pd.DataFrame(np.hstack([out['onehot'] for out in onehot]), columns=names, index=index))
+
+    frames = []
+    for out in onehot:
+        if sp.issparse(out['onehot']):
+            frame = pd.DataFrame.sparse.from_spmatrix(out['onehot'], columns=out['names'], index=index).astype(pd.SparseDtype(bool, False))
+        elif sparse and out['onehot'].dtype==bool:
+            frame = pd.DataFrame(out['onehot'], columns=out['names'], index=index).astype(pd.SparseDtype(bool, False))
+        else:
+            frame = pd.DataFrame(out['onehot'], columns=out['names'], index=index)
+        frames.append(frame)
+    return(pd.concat(frames, axis=1))
+
 #%%
-def expand_column_with_list(df, dtypes, verbose=3):
+def expand_column_with_list(df, dtypes, sparse=False, verbose=3):
     # Check for any lists in dtypes
     Icol=np.isin(dtypes,'list')
     
     # If any
     if np.any(Icol):
-        # Empty df
-        df_list_to_onehot=pd.DataFrame()
-        idxCol=np.where(Icol)[0]
-
-        # Expand columns with lists
-        for i in range(0,len(idxCol)):
-            if verbose>=3: print('[DF2ONEHOT] Column is detected as list and expanded: [%s]' %(df.columns[idxCol[i]]))
-            uielements=np.unique(sum(df.iloc[:,idxCol[i]].to_list(),[]))
-            
-            A=df.iloc[:,idxCol[i]].apply(findcol, cols=uielements)
-            arr = np.concatenate(A).reshape((A.shape[0],A[0].shape[0]))
-            df1=pd.DataFrame(index=np.arange(0,df.shape[0]), columns=uielements, data=arr,  dtype='bool')
-            
-            # Combine in one big matrix
-            df_list_to_onehot=pd.concat([df_list_to_onehot.astype(bool),df1], axis=1)
-        # Drop columns that are expanded
-        df.drop(labels=df.columns[Icol].values, axis=1, inplace=True)
-        # Combine new one-hot-colums with 
-        df=pd.concat([df,df_list_to_onehot], axis=1)
+        frames=[df.loc[:,~Icol]]
+        dtypes=list(np.array(dtypes)[~Icol])
+
+        # Expand columns with lists. The elements are the sorted unique values over all lists in the column.
+        for col in df.columns[Icol]:
+            if verbose>=3: print('[DF2ONEHOT] Column is detected as list and expanded: [%s]' %(col))
+            [arr, uielements] = _list2onehot(df[col], sparse=sparse)
+            if sparse:
+                df1 = pd.DataFrame.sparse.from_spmatrix(arr, columns=uielements, index=df.index).astype(pd.SparseDtype(bool, False))
+            else:
+                # Typed as categorical, similar as set_dtypes does for a boolean column
+                df1 = pd.DataFrame(_bool2str(arr), columns=uielements, index=df.index)
+            frames.append(df1)
+            dtypes = dtypes + ['cat']*len(uielements)
+
+        # Combine new one-hot-colums with the remaining columns
+        df=pd.concat(frames, axis=1)
     
-    # Redo the typing
-    [df, dtypes] = set_dtypes(df, verbose=0)
     # Return
     return(df, dtypes)
 
 #%%
 def findcol(x, cols):
      return(np.isin(cols,x))
+
+#%% Boolean matrix with the presence of each element in the list of each row
+def _list2onehot(values, elements=None, sparse=False):
+    n = len(values)
+    [rows, values] = _explode_lists(values)
+    if elements is None:
+        # All elements that are present, sorted
+        [col, elements] = pd.factorize(values, sort=True)
+        elements = np.asarray(elements)
+    else:
+        # Only the given elements
+        col = pd.Index(elements).get_indexer(values)
+        [rows, col] = [rows[col>=0], col[col>=0]]
+
+    if sparse:
+        out = sp.csc_matrix((np.ones(len(rows), dtype=bool), (rows, col)), shape=(n, len(elements)))
+        out.sum_duplicates()
+    else:
+        out = np.zeros((n, len(elements)), dtype=bool)
+        out[rows, col] = True
+    return(out, elements)
+
+#%% Elements of the lists as strings, and the row of each element. Both the expansion and the encoder use these labels.
+def _explode_lists(values):
+    values = pd.Series(values.values).explode()
+    values = values[values.notna().values]
+    return(values.index.values, values.values.astype(str))
+
+#%% Booleans as the strings 'False' and 'True', without creating a string per value
+def _bool2str(arr):
+    return(np.array(['False', 'True'], dtype=object)[arr.astype(np.uint8)])
@@ -23,6 +23,11 @@
 
    X  = [1,2,3,1,1,2,2,3,4,None,None]
    [df_list, df_onehot] = dummyvar(X)
+
+   # Keep the one-hot matrix sparse
+   X  = np.random.randint(0,10000,1000000)
+   [df_list, df_onehot] = dummyvar(X, sparse=True)
+   csr = df_onehot.sparse.to_coo().tocsr()
  
 """
  
@@ -40,13 +45,16 @@ import numpy as np
 import pandas as pd
 
 #%% Main
-def dummyvar(data):
+def dummyvar(data, sparse=False):
     '''
 
     Parameters
     ----------
     data : list
         DESCRIPTION.
+    sparse : Bool, Keep the one-hot matrix sparse. The columns of df_onehot are pandas sparse boolean columns.
+        False (default)
+        True
 
     Returns
     -------
@@ -89,9 +97,13 @@ def dummyvar(data):
     
     # Convert to binairy values
     onehotenc = OneHotEncoder() # Specify the index in X that requires onehotencoding = [0]
-    out_bin   = onehotenc.fit_transform(out_cat).toarray()
-    out_bin   = pd.DataFrame(data=out_bin,columns=out_labx)
-    out_bin   = out_bin.astype(bool)
+    out_bin   = onehotenc.fit_transform(out_cat)
+    if sparse:
+        out_bin = pd.DataFrame.sparse.from_spmatrix(out_bin, columns=out_labx)
+        out_bin = out_bin.astype(pd.SparseDtype(bool, False))
+    else:
+        out_bin = pd.DataFrame(data=out_bin.toarray(),columns=out_labx)
+        out_bin = out_bin.astype(bool)
     
     # Re-arrange dataframe for NaN values
     I = out_bin.columns.isnull()
@@ -102,10 +114,10 @@ def dummyvar(data):
         # Drop columns with NaN
         out_bin.drop(out_bin.columns[np.where(I)], inplace=True, axis=1)
         # Add combined column of NaN
-        out_bin[None]=tmpNaN
+        out_bin[None]=pd.arrays.SparseArray(tmpNaN, fill_value=False) if sparse else tmpNaN
     
     # Make dataframe and add label
-    out_cat      = pd.DataFrame(data=out_cat,columns={'labx_num'})
+    out_cat      = pd.DataFrame(data=out_cat,columns=['labx_num'])
     # Add original data column   
     out_cat = out_cat.assign(labx=data)
 
@@ -4,15 +4,48 @@
    list1:           numpy array
    list2:           numpy array
 
+ OPTIONAL
+
+   method:          String: Engine that is used to match the elements
+                    'auto'  (default): 'hash' for large or string/object inputs, 'sort' otherwise
+                    'sort'  : np.isin/np.unique based matching, O(n log n)
+                    'hash'  : Single hash-table build on list2 and probe with list1, O(n)
+                    'lookup': Dense lookup table for pd.Categorical or small-range integer inputs
+
+   rows:            Boolean: Match complete rows of 2D arrays or DataFrames (MATLAB 'rows')
+                    False (default)
+                    True
+
  OUTPUT
 	output
 
+	A= IsMemberIndex(list2)
+	A.query(list1)
+
+	for I, idx in ismember_chunks(chunks, list2, <optional>)
+
  DESCRIPTION
    MATLAB equivalent ismember function
    [LIA,LOCB] = ISMEMBER(A,B) also returns an array LOCB containing the
    lowest absolute index in B for each element in A which is a member of
    B and 0 if there is no such index.
    https://stackoverflow.com/questions/15864082/python-equivalent-of-matlabs-ismember-function
+   The 'hash' method builds one hash table of the first occurrences in B and probes
+   it with A, instead of the four sort based passes of the 'sort' method.
+   Categorical inputs and integer inputs with a small range are matched through a dense
+   lookup array on the (category) codes, without hashing or sorting the values.
+   Missing values (None/NaN) in A are matched to the first missing value in B.
+   Pandas inputs are read through a view on their values: the input is never written
+   to, and besides the boolean missing-value masks no copy of A is made. The 'hash'
+   method holds a table of the unique values of B; the 'sort' method needs memory for
+   the sorted copies made by np.unique.
+   When B is the same for many calls, build the IsMemberIndex once and query it with
+   each A. The index can be pickled (the hash table is rebuilt on first use after
+   unpickling), or saved to disk and memory-mapped in workers.
+   For inputs larger than memory, ismember_chunks yields (I, idx) per chunk of A;
+   only the index of B and one chunk of A are held in memory at any time.
+   With rows=True, each column is encoded to integer codes and the codes are packed
+   into one integer key per row. No intermediate string columns are created.
 
  EXAMPLE
     import numpy as np
@@ -47,6 +80,27 @@
     b_vec[I]
     a_vec[idx]
 
+    a_vec   = np.random.randint(0,1000000,10000000)
+    b_vec   = np.random.randint(0,1000000,1000000)
+    [I,idx] = ismember(a_vec,b_vec, method='hash')
+
+    from etutils.ismember import IsMemberIndex
+    index   = IsMemberIndex(b_vec)
+    [I,idx] = index.query(a_vec)
+    index.save('./index.npy')
+    index   = IsMemberIndex.load('./index.npy', mmap_mode='r')
+
+    a_vec   = pd.DataFrame({'id':[1,2,3,1], 'name':['aap','boom','mies','boom']})
+    b_vec   = pd.DataFrame({'id':[3,1,1], 'name':['mies','boom','aap']})
+    [I,idx] = ismember(a_vec, b_vec, rows=True)
+    a_vec.loc[I]
+    b_vec.iloc[idx]
+
+    from etutils.ismember import ismember_chunks
+    a_vec   = np.memmap('./data.dat', dtype='float32', mode='r')
+    for I, idx in ismember_chunks(a_vec, b_vec, chunksize=1000000):
+        print(I.sum())
+
 """
 #print(__doc__)
 
@@ -59,21 +113,157 @@
 #--------------------------------------------------------------------------
 
 #%%
+from collections.abc import Iterator
 import numpy as np
+import pandas as pd
+# Custom
+from etutils.slice_array import slice_chunks
+
+#%% Minimal number of elements to prefer the hash-engine for numerical data
+HASH_MIN_SIZE = 10000
+# Maximum range of integers, relative to the number of elements, to use the lookup-engine
+LOOKUP_MAX_RANGE = 2
 
-def ismember(a_vec, b_vec):
-    I   = []
-    idx = []
+#%% Main
+def ismember(a_vec, b_vec, method='auto', rows=False):
+    # Match on rows by packing each row into a single key
+    if rows:
+        [a_vec, b_vec] = _rows2keys(a_vec, b_vec)
+    # Match categorical on codes
+    if (method in ['auto','lookup']) and _is_categorical(a_vec) and _is_categorical(b_vec):
+        return(_ismember_categorical(a_vec, b_vec))
 
     # Check type
-    if 'pandas' in str(type(a_vec)):
-         a_vec.values[np.where(a_vec.values==None)]='NaN'
-         a_vec = np.array(a_vec.values)
-    if 'pandas' in str(type(b_vec)):
-         b_vec.values[np.where(b_vec.values==None)]='NaN'
-         b_vec = np.array(b_vec.values)
-    
-    #
+    a_vec = _get_values(a_vec)
+    b_vec = _get_values(b_vec)
+
+    # Select engine
+    method = _get_method(a_vec, b_vec, method)
+    if method=='hash':
+        [I, idx] = _ismember_hash(a_vec, b_vec)
+    elif method=='sort':
+        [I, idx] = _ismember_sort(a_vec, b_vec)
+    elif method=='lookup':
+        [I, idx] = _ismember_lookup(a_vec, b_vec)
+    else:
+        raise ValueError('[ISMEMBER] method should be: "auto", "sort", "hash" or "lookup"')
+
+    return(I,idx)
+
+#%% Streaming
+def ismember_chunks(a_chunks, b_vec, chunksize=1000000):
+    """ismember for inputs that do not fit in memory.
+
+    Parameters
+    ----------
+    a_chunks : iterator of array-like, or array-like (list, pd.Series, pd.DataFrame, np.ndarray, np.memmap)
+        Chunks of a_vec. An iterator or generator yields the chunks, any other input is sliced in chunks of chunksize along the first axis.
+    b_vec : array-like or IsMemberIndex
+        Reference vector, the index is build once.
+    chunksize : int, (default: 1000000)
+        Number of rows per chunk when a_chunks is not an iterator.
+
+    Yields
+    ------
+    tuple (I, idx)
+        Output of ismember(chunk, b_vec) for each chunk.
+
+    """
+    if not isinstance(b_vec, IsMemberIndex):
+        b_vec = IsMemberIndex(b_vec)
+    # Only iterators and generators are streams of chunks, array-likes are sliced
+    if not isinstance(a_chunks, Iterator):
+        if not hasattr(a_chunks, 'shape'):
+            a_chunks = np.asarray(a_chunks)
+        a_chunks = slice_chunks(a_chunks, chunksize)
+
+    for chunk in a_chunks:
+        yield(b_vec.query(chunk))
+
+#%% Convert rows to integer keys
+def _rows2keys(a_vec, b_vec):
+    a_cols = _get_columns(a_vec)
+    b_cols = _get_columns(b_vec)
+    if len(a_cols)!=len(b_cols):
+        raise ValueError('[ISMEMBER] Number of columns in a_vec and b_vec does not match')
+
+    a_key = np.zeros(len(a_cols[0]), dtype=np.int64)
+    b_key = np.zeros(len(b_cols[0]), dtype=np.int64)
+    nkeys = 1
+    for a_col, b_col in zip(a_cols, b_cols):
+        # Encode column to codes of the unique elements in b
+        uniq = pd.Index(pd.unique(b_col))
+        b_code = uniq.get_indexer(b_col)
+        a_code = uniq.get_indexer(a_col)
+        # Re-encode the keys to dense codes when the packed key would overflow
+        if nkeys*len(uniq)>=2**62:
+            [a_key, b_key, nkeys] = _densify_keys(a_key, b_key)
+        # Rows with an element that is not in b can never match
+        a_key = np.where((a_key<0) | (a_code<0), -1, a_key*len(uniq) + a_code)
+        b_key = b_key*len(uniq) + b_code
+        nkeys = nkeys*len(uniq)
+
+    return(a_key, b_key)
+
+#%% Renumber keys to 0..number of unique keys in b
+def _densify_keys(a_key, b_key):
+    uniq = pd.Index(pd.unique(b_key))
+    a_code = uniq.get_indexer(a_key)
+    a_code[a_key<0] = -1
+    return(a_code, uniq.get_indexer(b_key), len(uniq))
+
+#%% Get list of columns from 2D input
+def _get_columns(data):
+    if isinstance(data, pd.DataFrame):
+        return([data.iloc[:,i].values for i in range(data.shape[1])])
+    data = np.asarray(data)
+    if data.ndim!=2:
+        raise ValueError('[ISMEMBER] rows=True requires 2D input')
+    return([data[:,i] for i in range(data.shape[1])])
+
+#%% Determine which method to use
+def _get_method(a_vec, b_vec, method):
+    if method!='auto':
+        return(method)
+    # Integers in a small range
+    if (a_vec.dtype.kind in 'iu') and (b_vec.dtype.kind in 'iu') and (b_vec.size>0):
+        if (int(b_vec.max()) - int(b_vec.min())) <= LOOKUP_MAX_RANGE*(a_vec.size + b_vec.size):
+            return('lookup')
+    # Strings and objects are compared as Python objects when sorting
+    if (a_vec.dtype.kind in 'OUS') or (b_vec.dtype.kind in 'OUS'):
+        return('hash')
+    if (a_vec.size + b_vec.size)>=HASH_MIN_SIZE:
+        return('hash')
+    return('sort')
+
+#%% Get values without copying or changing the input
+def _get_values(data):
+    if isinstance(data, (pd.Series, pd.DataFrame, pd.Index)):
+        return(data.to_numpy(copy=False))
+    return(np.asarray(data))
+
+#%% Sort based matching
+def _ismember_sort(a_vec, b_vec):
+    a_nan = pd.isna(a_vec)
+    b_nan = pd.isna(b_vec).ravel()
+    if (not np.any(a_nan)) and (not np.any(b_nan)):
+        return(_ismember_sorted(a_vec, b_vec))
+
+    # Match the non-missing values and set missing values to the first missing value in b
+    b_vec = b_vec.ravel()
+    b_pos = np.flatnonzero(~b_nan)
+    [I_ok, idx_ok] = _ismember_sorted(a_vec[~a_nan], b_vec[b_pos])
+    loc = np.full(a_vec.shape, -1)
+    loc_ok = np.full(len(I_ok), -1)
+    loc_ok[I_ok] = b_pos[idx_ok]
+    loc[~a_nan] = loc_ok
+    if np.any(b_nan):
+        loc[a_nan] = np.flatnonzero(b_nan)[0]
+
+    I = loc>=0
+    return(I,loc[I])
+
+def _ismember_sorted(a_vec, b_vec):
     bool_ind = np.isin(a_vec,b_vec)
     common = a_vec[bool_ind]
     [common_unique, common_inv]  = np.unique(common, return_inverse=True)     # common = common_unique[common_inv]
@@ -83,4 +273,156 @@ def ismember(a_vec, b_vec):
     I=bool_ind
     idx=common_ind[common_inv]
 
-    return(I,idx)    
\ No newline at end of file
+    return(I,idx)
+
+#%% Lookup based matching for integers
+def _ismember_lookup(a_vec, b_vec):
+    if (a_vec.dtype.kind not in 'iu') or (b_vec.dtype.kind not in 'iu'):
+        raise ValueError('[ISMEMBER] method="lookup" requires integer or categorical inputs')
+    if b_vec.size==0:
+        return(np.zeros(a_vec.shape, dtype=bool), np.zeros(0, dtype=int))
+    offset = int(b_vec.min())
+    a_code = np.subtract(a_vec, offset, dtype=np.int64)
+    b_code = np.subtract(b_vec.ravel(), offset, dtype=np.int64)
+    [loc, I] = _lookup(a_code, b_code, int(b_code.max())+1)
+    return(I,loc[I])
+
+#%% Lookup based matching for categorical
+def _ismember_categorical(a_vec, b_vec):
+    a_cat = pd.Categorical(a_vec)
+    b_cat = pd.Categorical(b_vec)
+    # Map the categories of a on the categories of b. Code 0 is for missing values.
+    cat_map = np.append(0, b_cat.categories.get_indexer(a_cat.categories) + 1)
+    cat_map[cat_map==0] = -1
+    cat_map[0] = 0
+    [loc, I] = _lookup(cat_map[a_cat.codes + 1], b_cat.codes.astype(np.int64) + 1, len(b_cat.categories)+1)
+    a_shape = np.shape(a_vec)
+    return(I.reshape(a_shape),loc[I])
+
+def _lookup(a_code, b_code, n):
+    # Table with the first position of each code in b. Codes outside [0, n) are not in b.
+    table = np.full(n+1, -1)
+    table[b_code[::-1]] = np.arange(len(b_code))[::-1]
+    # Negative codes become large unsigned values and are clipped to n together with codes >=n
+    a_code = np.minimum(a_code.view(np.uint64), n)
+    loc = table[a_code]
+    return(loc, loc>=0)
+
+def _is_categorical(data):
+    return(isinstance(getattr(data, 'dtype', None), pd.CategoricalDtype))
+
+#%% Hash based matching
+def _ismember_hash(a_vec, b_vec):
+    return(IsMemberIndex(b_vec).query(a_vec))
+
+#%% Prebuilt index
+class IsMemberIndex:
+    """Hash table on the reference vector b_vec that can be queried many times.
+
+    Parameters
+    ----------
+    b_vec : array-like
+        Reference vector. Only the first occurrence of each element is stored.
+
+    Examples
+    --------
+    >>> index = IsMemberIndex(b_vec)
+    >>> [I, idx] = index.query(a_vec)
+
+    """
+    def __init__(self, b_vec=None):
+        self.values = np.array([])
+        self.positions = np.array([], dtype=np.int64)
+        self._table = None
+        self._table_positions = None
+        if b_vec is not None:
+            b_vec = _get_values(b_vec).ravel()
+            # First occurrence of each element in b
+            b_first = ~pd.Index(b_vec).duplicated(keep='first')
+            self.values = b_vec[b_first]
+            self.positions = np.flatnonzero(b_first)
+
+    def __len__(self):
+        return(len(self.positions))
+
+    def __getstate__(self):
+        # The hash table is rebuilt on first use after unpickling
+        return({'values': self.values, 'positions': self.positions})
+
+    def __setstate__(self, state):
+        self.values = state['values']
+        self.positions = state['positions']
+        self._table = None
+        self._table_positions = None
+
+    @property
+    def table(self):
+        if self._table is None:
+            # Missing values (None/NaN) are kept out of the table and matched on a mask
+            isnan = pd.isna(self.values)
+            self._table = pd.Index(self.values[~isnan])
+            self._table_positions = np.append(self.positions[~isnan], self.positions[isnan].min() if np.any(isnan) else -1)
+        return(self._table)
+
+    def query(self, a_vec):
+        """Lookup a_vec in the index.
+
+        Parameters
+        ----------
+        a_vec : array-like
+
+        Returns
+        -------
+        tuple (I, idx)
+            Same output as ismember(a_vec, b_vec).
+
+        """
+        a_vec = _get_values(a_vec)
+        loc = self.table.get_indexer(a_vec.ravel())
+        # Missing values in a are matched to the first missing value in b
+        if self._table_positions[-1]>=0:
+            loc[pd.isna(a_vec.ravel())] = len(self._table)
+        I = loc>=0
+        idx = self._table_positions[loc[I]]
+        return(I.reshape(a_vec.shape),idx)
+
+    def save(self, filename, verbose=3):
+        """Save the index to a .npy file that can be loaded memory-mapped."""
+        out = np.empty(len(self), dtype=[('values', self.values.dtype), ('positions', np.int64)])
+        out['values'] = self.values
+        out['positions'] = self.positions
+        np.save(filename, out, allow_pickle=(self.values.dtype.kind=='O'))
+        if verbose>=3: print('[ISMEMBER] Index saved: [%s]' %(filename))
+
+    @classmethod
+    def load(cls, filename, mmap_mode=None, verbose=3):
+        """Load a saved index.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the .npy file written by save().
+        mmap_mode : str, (default: None)
+            Memory-map mode passed to np.load, e.g. 'r'.
+        verbose : int, (default: 3)
+
+        Notes
+        -----
+        Indexes on object (string) values are stored pickled. These are unpickled in memory and can not be memory-mapped,
+        so only load object indexes from files that you trust.
+
+        """
+        with open(filename, 'rb') as fid:
+            version = np.lib.format.read_magic(fid)
+            read_header = np.lib.format.read_array_header_1_0 if version==(1, 0) else np.lib.format.read_array_header_2_0
+            dtype = read_header(fid)[2]
+        if dtype.hasobject:
+            if verbose>=2 and mmap_mode is not None: print('[ISMEMBER] Index contains Python objects and can not be memory-mapped.')
+            out = np.load(filename, allow_pickle=True)
+        else:
+            out = np.load(filename, mmap_mode=mmap_mode)
+        if verbose>=3: print('[ISMEMBER] Index loaded: [%s]' %(filename))
+
+        index = cls()
+        index.__setstate__({'values': out['values'], 'positions': out['positions']})
+        return(index)
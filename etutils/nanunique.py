@@ -7,25 +7,83 @@
                    
  OPTIONAL
 
+   sort:           Boolean [0,1]: Sort the unique values
+                   1: Yes (default)
+                   0: No, in order of first appearance
+
+   method:         String: Engine that is used
+                   'auto' (default): 'lookup' if possible, 'hash' otherwise
+                   'hash'  : Single pass with a hash table, None/NaN are one value
+                   'sort'  : np.unique on the non-missing values, None/NaN are one value
+                   'lookup': Dense lookup on codes for pd.Categorical and small-range integers
+
+   return_inverse: Boolean: Also return the positions in the unique-values to reconstruct data
+                   False (default)
+
+   return_counts:  Boolean: Also return the number of occurrences of each unique value
+                   False (default)
 
  OUTPUT
-	unique-values and index
+	unique-values and index (and inverse and counts if requested, in that order)
+
+	A= NanUniqueAccumulator()
+	A.update(chunk)
+	A.merge(B)
+	A.result(<optional>)
+
+	A= nanunique_approx(data, <optional>)
+	A= NanUniqueSketch(<optional>)
 
  DESCRIPTION
    This function gives a unique list back which can handles None/nan values. It uses and also outputs the index
+   pd.Categorical inputs and integer arrays with a small range are not sorted but counted
+   on their codes with a dense lookup array. Missing values are placed last.
+   All other inputs are factorized in a single pass with a hash table, which gives the
+   unique values in order of first appearance without sorting the data. Only the unique
+   values are sorted when sort=1.
+   NanUniqueAccumulator collects the unique values and counts of chunks of a column, such
+   as rows from etutils.filefun.fileread or slices of a memmap. Only the uniques are kept
+   in memory. Accumulators of different processes are combined with merge().
+   nanunique_approx estimates the number of distinct values with a HyperLogLog sketch.
+   The sketch uses 2**precision registers of one byte, independent of the size of the
+   data, and has a relative standard error of about 1.04/sqrt(2**precision): 0.8% for
+   the default precision of 14. Sketches of parallel chunks are combined with merge().
 
  EXAMPLE
    import numpy as np
+   import pandas as pd
    from etutils.nanunique import nanunique
 
    data=[None,'aap','aap','boom',None,'boom','mies','mies',None]
    data=['aap','aap','boom','boom','mies','mies']
-   data=np.array([1,1,2,2,3,3,3,None,4,4,4,4,5,5,5,5,5,None],dtype=np.float)
+   data=[1,'aap','boom',None,'aap']
+   data=np.array([1,1,2,2,3,3,3,None,4,4,4,4,5,5,5,5,5,None],dtype=float)
    data=[5,3,1,3,2,3,3,3,4,4,3,4,4,5,None,4,5,5,1,5,5]
    [A,idx] = nanunique(data, sort=0)
 
    [np.array(data)[idx], A]
 
+   data=pd.Categorical(['mies','aap',None,'mies','boom'])
+   [A,idx] = nanunique(data, sort=0)
+
+   [A,idx,inverse,counts] = nanunique(data, return_inverse=True, return_counts=True)
+   A[inverse]
+
+   from etutils.nanunique import NanUniqueAccumulator
+   data = np.memmap('./data.dat', dtype='float32', mode='r')
+   acc = NanUniqueAccumulator()
+   for i in range(0, len(data), 1000000):
+       acc.update(data[i:i+1000000])
+   [A,idx,counts] = acc.result()
+
+   from etutils.nanunique import nanunique_approx, NanUniqueSketch
+   n = nanunique_approx(np.random.randint(0,1000000,10000000), precision=14)
+
+   sketch = NanUniqueSketch(precision=14)
+   for i in range(0, len(data), 1000000):
+       sketch.update(data[i:i+1000000])
+   n = sketch.count()
+
  SEE ALSO
 
 """
@@ -41,52 +99,320 @@
 
 #%% Libraries
 import numpy as np
+import pandas as pd
+# Custom
+from etutils.ismember import LOOKUP_MAX_RANGE
 
 #%%
-def nanunique(data, sort=1):
+def nanunique(data, sort=1, method='auto', return_inverse=False, return_counts=False):
 	# DECLARATIONS
     out =[]
     index=[]
     # Make dictionary to store Parameters
     Param = {}
     Param['sort'] = sort
-    
+    Param['method'] = method
+    Param['return_inverse'] = return_inverse
+    Param['return_counts'] = return_counts
+    if Param['method']=='auto':
+        Param['method'] = 'lookup' if _use_lookup(data) else 'hash'
+
     # Replace None values with 'nan'
+    raw = data
     gettype=''
     if 'list' in str(type(data)):
         try:
             # Make type float
-            data = np.array(data,dtype=np.float)
+            data = np.array(data,dtype=float)
             gettype='float'
         except:
             #For string
-            data=['None' if i is None else i for i in data]
             gettype='string'
 
     elif 'numpy' in str(type(data)):
         gettype='float'
 
     # Make unique
-    [out, index] = np.unique(data, return_index=True)
-
-    # Unique without sort
-    if Param['sort']==0:
-        out=out[index.argsort()]
-        index=index[index.argsort()]
-
-    # Get only not NaN values
-    if gettype=='float':
-        if np.any(np.isnan(out)):
-            I=~np.isnan(out)
-            out=out[I]
-            out=np.append(out,np.nan)
-            
-            # Get index
-            index=index[I]
-            I=np.isnan(data)
-            index=np.append(index,np.where(I==True)[0][0])
+    if Param['method']=='lookup':
+        # Categorical and small-range integers are counted on their codes
+        [out, index, inverse, counts] = _nanunique_lookup(raw)
+    elif Param['method']=='hash':
+        # Single pass with hash table
+        [out, index, inverse, counts] = _nanunique_hash(data)
+    elif Param['method']=='sort':
+        # Sort the non-missing values
+        [out, index, inverse, counts] = _nanunique_sort(data)
+    else:
+        raise ValueError('[NANUNIQUE] method should be: "auto", "hash", "sort" or "lookup"')
+
+    # Order the unique values and place NaN values last
+    [out, index, inverse, counts] = _set_order(out, index, inverse, counts, sort=Param['sort'], return_inverse=Param['return_inverse'])
 
     if gettype=='string':
         out = out.tolist()
 
-    return(out,index)
+    # Output
+    args = [out, index]
+    if Param['return_inverse']:
+        args.append(inverse)
+    if Param['return_counts']:
+        args.append(counts)
+    return(tuple(args))
+
+#%% Accumulate unique values over chunks
+class NanUniqueAccumulator:
+    """Unique values and counts of a column that is processed in chunks.
+
+    Examples
+    --------
+    >>> acc = NanUniqueAccumulator()
+    >>> for chunk in chunks:
+    >>>     acc.update(chunk)
+    >>> [out, index, counts] = acc.result()
+
+    """
+    def __init__(self):
+        self.values = np.array([])
+        self.index = np.array([], dtype=np.int64)
+        self.counts = np.array([], dtype=np.int64)
+        self.n = 0
+
+    def update(self, data):
+        """Add a chunk. The index is counted from the first element of the first chunk."""
+        [out, index, counts] = nanunique(np.asarray(data).ravel(), sort=0, return_counts=True)
+        self._add(out, index + self.n, counts)
+        self.n = self.n + np.size(data)
+        return(self)
+
+    def merge(self, other):
+        """Add the results of another accumulator that processed the data after this one."""
+        self._add(other.values, other.index + self.n, other.counts)
+        self.n = self.n + other.n
+        return(self)
+
+    def result(self, sort=1):
+        """Return the unique values, index of first occurrence and counts."""
+        [out, index, _, counts] = _set_order(self.values, self.index, None, self.counts, sort=sort)
+        return(out, index, counts)
+
+    def _add(self, values, index, counts):
+        values = np.append(self.values, values) if self.n>0 else np.asarray(values)
+        index = np.append(self.index, index)
+        counts = np.append(self.counts, counts)
+        # The first entry of a value is the earliest as new entries are appended
+        [out, first, inverse, _] = _nanunique_hash(values)
+        self.values = out
+        self.index = index[first]
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(out)).astype(np.int64)
+
+#%% Approximate number of unique values
+def nanunique_approx(data, precision=14, chunksize=1000000):
+    """Estimate the number of unique values, None/NaN counted as one value.
+
+    Parameters
+    ----------
+    data : array-like
+    precision : int, [4..18] (default: 14)
+        Number of registers is 2**precision.
+    chunksize : int, (default: 1000000)
+        Number of elements that are hashed at once.
+
+    Returns
+    -------
+    int
+
+    """
+    sketch = NanUniqueSketch(precision=precision)
+    data = data if isinstance(data, np.ndarray) else np.asarray(data, dtype=object)
+    data = data.ravel()
+    for i in range(0, len(data), chunksize):
+        sketch.update(data[i:i+chunksize])
+    return(sketch.count())
+
+#%% HyperLogLog sketch
+class NanUniqueSketch:
+    """HyperLogLog sketch to estimate the number of unique values in a single pass.
+
+    Parameters
+    ----------
+    precision : int, [4..18] (default: 14)
+        Number of registers is 2**precision.
+
+    Examples
+    --------
+    >>> sketch = NanUniqueSketch()
+    >>> sketch.update(data)
+    >>> sketch.merge(other_sketch)
+    >>> n = sketch.count()
+
+    """
+    def __init__(self, precision=14):
+        if (precision<4) or (precision>18):
+            raise ValueError('[NANUNIQUE] precision should be in range [4..18]')
+        self.precision = precision
+        self.registers = np.zeros(2**precision, dtype=np.uint8)
+
+    def update(self, data):
+        """Add the values of a chunk to the sketch."""
+        data = np.asarray(data).ravel()
+        if len(data)==0:
+            return(self)
+        hashes = _hash_values(data)
+        # All missing values get the same hash
+        hashes[np.asarray(pd.isna(data))] = 0
+
+        p = self.precision
+        # The first p bits select the register
+        idx = (hashes >> np.uint64(64-p)).astype(np.int64)
+        # Position of the first 1-bit in the remaining 64-p bits
+        rest = hashes & np.uint64(2**(64-p)-1)
+        high = np.frexp((rest >> np.uint64(32)).astype(np.float64))[1]
+        low = np.frexp((rest & np.uint64(2**32-1)).astype(np.float64))[1]
+        rho = (64-p) - np.where(high>0, high+32, low) + 1
+
+        # Maximum rho per register
+        seen = np.zeros((len(self.registers), 66-p), dtype=bool)
+        seen[idx, rho] = True
+        rho_max = (65-p) - np.argmax(seen[:, ::-1], axis=1)
+        rho_max[~seen.any(axis=1)] = 0
+        self.registers = np.maximum(self.registers, rho_max.astype(np.uint8))
+        return(self)
+
+    def merge(self, other):
+        """Combine with a sketch of the same precision."""
+        if other.precision!=self.precision:
+            raise ValueError('[NANUNIQUE] Sketches with different precision can not be merged')
+        self.registers = np.maximum(self.registers, other.registers)
+        return(self)
+
+    def count(self):
+        """Estimated number of unique values."""
+        m = len(self.registers)
+        alpha = 0.7213/(1+1.079/m)
+        estimate = alpha*m*m/np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        # Small range correction
+        zeros = np.sum(self.registers==0)
+        if (estimate<=2.5*m) and (zeros>0):
+            estimate = m*np.log(m/zeros)
+        return(int(round(estimate)))
+
+#%% Hash of each value. Numbers get the same hash for every numeric dtype: whole numbers are hashed as int64, others as float64.
+def _hash_values(data):
+    if data.dtype.kind in 'biu':
+        return(pd.util.hash_array(data.astype(np.int64)))
+    if data.dtype.kind=='f':
+        data = data.astype(np.float64)
+        hashes = pd.util.hash_array(data)
+        whole = np.isfinite(data) & (np.abs(data)<2**63)
+        whole[whole] = np.modf(data[whole])[0]==0
+        hashes[whole] = pd.util.hash_array(data[whole].astype(np.int64))
+        return(hashes)
+    return(pd.util.hash_array(data))
+
+#%% Order unique values
+def _set_order(out, index, inverse, counts, sort=1, return_inverse=True):
+    # Missing values are placed last and combined into one value
+    isnan = np.asarray(pd.isna(out))
+    if sort==0:
+        order = np.argsort(index, kind='stable')
+    else:
+        order = np.flatnonzero(~isnan)
+        try:
+            order = order[np.argsort(out[order], kind='stable')]
+        except TypeError:
+            # Mixed types, such as int and str, can not be compared and are sorted on their string representation
+            order = order[np.argsort(out[order].astype(str), kind='stable')]
+        order = np.append(order, np.flatnonzero(isnan))
+    keep = order[~isnan[order]]
+    nans = order[isnan[order]]
+
+    # Rank of each unique value in the new order
+    if return_inverse and (inverse is not None):
+        rank = np.zeros(len(out), dtype=np.int64)
+        rank[keep] = np.arange(len(keep))
+        rank[nans] = len(keep)
+        inverse = rank[inverse]
+
+    if len(nans)>0:
+        out = np.append(out[keep], np.nan)
+        index = np.append(index[keep], index[nans].min())
+        counts = np.append(counts[keep], counts[nans].sum())
+    else:
+        out = out[keep]
+        index = index[keep]
+        counts = counts[keep]
+    return(out, index, inverse, counts)
+
+#%% Unique with hash table
+def _nanunique_hash(data):
+    data = np.asarray(data, dtype=object) if isinstance(data, list) else np.asarray(data).ravel()
+    # Codes are given in order of first appearance, missing values get code -1
+    [codes, out] = pd.factorize(data, sort=False)
+    out = np.asarray(out)
+    # Missing values are added as the last code
+    isnan = codes<0
+    if np.any(isnan):
+        out = np.append(out, np.nan)
+        codes[isnan] = len(out)-1
+    # First position of each code is where the running maximum of the codes increases
+    index = np.flatnonzero(np.diff(np.maximum.accumulate(np.where(isnan, -1, codes)), prepend=-1)>0)
+    if np.any(isnan):
+        index = np.append(index, np.flatnonzero(isnan)[0])
+    counts = np.bincount(codes, minlength=len(out))
+    return(out, index, codes, counts)
+
+#%% Unique with np.unique, missing values are one value
+def _nanunique_sort(data):
+    data = np.asarray(data, dtype=object) if isinstance(data, list) or isinstance(getattr(data, 'dtype', None), pd.CategoricalDtype) else np.asarray(data).ravel()
+    isnan = np.asarray(pd.isna(data))
+    try:
+        [out, index, codes, counts] = np.unique(data[~isnan], return_index=True, return_inverse=True, return_counts=True)
+    except TypeError:
+        # Mixed types, such as int and str, can not be sorted. The order is set afterwards in _set_order.
+        return(_nanunique_hash(data))
+    if not np.any(isnan):
+        return(out, index, codes, counts)
+
+    # Missing values are added as the last code
+    inverse = np.full(len(data), len(out), dtype=np.int64)
+    inverse[~isnan] = codes
+    out = np.append(out, np.nan)
+    index = np.append(np.flatnonzero(~isnan)[index], np.flatnonzero(isnan)[0])
+    counts = np.append(counts, np.sum(isnan))
+    return(out, index, inverse, counts)
+
+#%% Check whether data can be handled with a lookup array
+def _use_lookup(data):
+    if isinstance(getattr(data, 'dtype', None), pd.CategoricalDtype):
+        return(True)
+    if isinstance(data, np.ndarray) and (data.dtype.kind in 'iu') and (data.size>0):
+        return((int(data.max()) - int(data.min())) <= LOOKUP_MAX_RANGE*data.size)
+    return(False)
+
+#%% Unique on codes
+def _nanunique_lookup(data):
+    if isinstance(getattr(data, 'dtype', None), pd.CategoricalDtype):
+        data = pd.Categorical(data)
+        # Code 0 is used for missing values
+        codes = data.codes.astype(np.int64) + 1
+        values = np.append(np.nan, data.categories.to_numpy())
+    else:
+        data = np.asarray(data).ravel()
+        if data.dtype.kind not in 'iu':
+            raise ValueError('[NANUNIQUE] method="lookup" requires integer or categorical inputs')
+        if data.size==0:
+            return(data, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        offset = int(data.min())
+        codes = np.subtract(data, offset, dtype=np.int64)
+        values = np.arange(offset, int(data.max())+1, dtype=data.dtype)
+
+    # First position and number of occurrences of each code
+    first = np.full(len(values), -1)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    present = np.flatnonzero(first>=0)
+    counts = np.bincount(codes, minlength=len(values))
+
+    # Positions of the codes in the present values
+    rank = np.zeros(len(values), dtype=np.int64)
+    rank[present] = np.arange(len(present))
+    return(values[present], first[present], rank[codes], counts[present])
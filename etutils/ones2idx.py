@@ -1,20 +1,51 @@
 """ This function searches for stretches of ones in a 1D array and then converts it to start-stop indices
 
 	A = ones2region(data, <optional>)
+	for A in ones2region_chunks(chunks, <optional>)
 	A = idx2region(data, <optional>)
 	A = region2ones(data, <optional>)
 	A = ones2idx(data, <optional>)
 	A = region2idx(data, <optional>)
+	A = Regions(start, stop)
+	A = RegionIndex(regions)
 
  INPUT:
-   data:           1D numpy array
+   data:           1D numpy array, or 2D numpy array with one channel per column (axis=0)
                    np.array([0,0,0,1,1,1,1,1,0,0,0,1,0])
+
+ OPTIONAL
+
+   value:          Value to search for
+                   1 (default)
+
+   axis:           Integer: Axis along which regions are detected in 2D arrays
+                   0 (default)
+
+   min_length:     Integer: Remove regions that are shorter
+                   None (default)
+
+   max_gap:        Integer: Merge regions that are separated by this number of indices or less
+                   None (default)
    
  OUTPUT
-	output
+	Regions: start and stop (inclusive) indices of the regions
+	pd.DataFrame with columns [channel, start, stop] for 2D arrays
 
  DESCRIPTION
    This function searches for stretches of ones in a 1D array and then converts it to start-stop indices
+   For 2D arrays all channels are processed at once, and max_gap and min_length are applied
+   on the start-stop arrays of all channels before any output is created.
+   region2ones and idx2region are vectorized: region2ones places +1/-1 at the boundaries of
+   each region and takes the cumulative sum, idx2region splits the indexes where np.diff!=1.
+   Regions are stored in a Regions object with two int64 arrays (start, stop). It behaves as a
+   list of (start, stop) tuples, and supports union, intersection, difference, complement and
+   merging of regions that are separated by a maximum gap.
+   ones2region_chunks processes chunks (generators or memmap slices) one by one and yields the
+   regions that are completed in each chunk. A region that continues into the next chunk is
+   stitched and yielded once it stops, so memory is bounded by the chunksize.
+   RegionIndex sorts the regions on start and answers batches of point queries with a single
+   np.searchsorted on the running maximum of the stops. Overlap queries use a nested containment
+   list, so the work is proportional to the number of returned pairs, also for overlapping regions.
 
  EXAMPLE
    from etutils.ones2idx import ones2region, idx2region, region2ones, ones2idx
@@ -33,7 +64,38 @@
    
    # Test
    data=np.array([1,0,0,1,1,1,1,1,0,0,0,1])
-   idx2ones(ones2region(data))==data
+   region2ones(ones2region(data))==data
+
+   # Multi-channel
+   data=np.random.randint(0,2,(100000,1000))
+   A = ones2region(data, axis=0, min_length=3, max_gap=1)
+
+   # Streaming over a memory mapped signal
+   data=np.memmap('./signal.dat', dtype='int8', mode='r')
+   for A in ones2region_chunks(data, chunksize=10000000):
+       print(len(A))
+
+   # Set operations
+   A = Regions([0,10],[5,20])
+   B = Regions.from_list([(3,12)])
+   A.union(B)
+   A.intersection(B)
+   A.difference(B)
+   A.complement(30)
+   A.merge(gap=5)
+   A.lengths()
+
+   # Point and overlap queries
+   index = RegionIndex(ones2region(np.random.randint(0,2,1000000)))
+   region = index.find(np.random.randint(0,1000000,1000000))
+   [query, region] = index.overlap([10,500], [20,600])
+
+   # Benchmark
+   from etutils.tictoc import tic, toc
+   data=np.random.randint(0,2,50000000)
+   regions=ones2region(data)
+   tic(); A=region2ones(regions); print(toc())
+   tic(); A=idx2region(ones2idx(data)); print(toc())
 
 """
 
@@ -46,44 +108,127 @@
 #--------------------------------------------------------------------------
 
 import numpy as np
+import pandas as pd
+# Custom
+from etutils.slice_array import slice_chunks
 
 #%% Convert to index
-def ones2region(data, value=1):
+def ones2region(data, value=1, axis=0, min_length=None, max_gap=None):
     Param = {}
     Param['value'] = value
+    Param['axis'] = axis
+    Param['min_length'] = min_length
+    Param['max_gap'] = max_gap
+    data=np.asarray(data)
+    is_2d=data.ndim==2
     
-    # Convert to one hot array
-    data=(data==Param['value']).astype(int)
+    # Convert to one hot array with one channel per row
+    if not is_2d:
+        data=(data==Param['value']).reshape(1,-1)
+    else:
+        data=np.moveaxis(data==Param['value'], Param['axis'], -1)
     
     # Append zero to begin and end to include starting and stopping ones
-    data=np.append(data,0)
-    data=np.append(0,data)
+    onehot=np.zeros((data.shape[0], data.shape[1]+2), dtype=np.int8)
+    onehot[:,1:-1]=data
     
-    # Determine boundaries
-    boundaries=np.diff(data,1)  
-    start=np.where(boundaries==1)[0]
-    stop=np.where(boundaries==-1)[0]-1
-    idx=list(zip(start,stop))
+    # Determine boundaries. Per channel, starts (+1) and stops (-1) alternate.
+    boundaries=np.flatnonzero(np.diff(onehot,1,axis=1))
+    [channel,start]=np.divmod(boundaries[0::2], onehot.shape[1]-1)
+    stop=boundaries[1::2] % (onehot.shape[1]-1) - 1
+
+    # Merge regions within the same channel that are separated by max_gap or less
+    if Param['max_gap'] is not None and len(start)>0:
+        new=np.append(True, (channel[1:]!=channel[:-1]) | (start[1:]-stop[:-1]-1 > Param['max_gap']))
+        stop=stop[np.append(np.flatnonzero(new)[1:]-1, len(stop)-1)]
+        start=start[new]
+        channel=channel[new]
+    # Remove short regions
+    if Param['min_length'] is not None:
+        I=(stop-start+1)>=Param['min_length']
+        [channel,start,stop]=[channel[I],start[I],stop[I]]
+
+    # Table for multiple channels
+    if is_2d:
+        idx=pd.DataFrame({'channel':channel, 'start':start, 'stop':stop})
+    else:
+        idx=Regions(start,stop)
         
     # END
     return(idx)
 
+#%% Convert chunks to index
+def ones2region_chunks(chunks, value=1, chunksize=1000000):
+    """Streaming version of ones2region.
+
+    Parameters
+    ----------
+    chunks : iterable of array-like, np.ndarray or np.memmap
+        Consecutive chunks of the signal. An array or memmap is sliced in chunks of chunksize.
+    value : (default: 1)
+        Value to search for.
+    chunksize : int, (default: 1000000)
+        Number of elements per chunk when chunks is an array.
+
+    Yields
+    ------
+    Regions
+        Regions that stop in the chunk, with indices relative to the start of the signal.
+
+    """
+    if isinstance(chunks, np.ndarray):
+        chunks = slice_chunks(chunks.ravel(), chunksize)
+
+    offset = 0
+    # Start of a region that continues from the previous chunk
+    open_start = -1
+    for chunk in chunks:
+        data = (np.asarray(chunk).ravel()==value).view(np.int8)
+        if len(data)==0:
+            continue
+
+        # Determine boundaries, the previous chunk ended with a one if a region is open
+        boundaries = np.diff(data, prepend=np.int8(open_start>=0))
+        start = np.flatnonzero(boundaries==1) + offset
+        stop = np.flatnonzero(boundaries==-1) + offset - 1
+        if open_start>=0:
+            start = np.append(open_start, start)
+        # Keep the last region open if it continues in the next chunk
+        if data[-1]:
+            open_start = start[-1]
+            start = start[:-1]
+        else:
+            open_start = -1
+
+        offset = offset + len(data)
+        yield(Regions(start, stop))
+
+    if open_start>=0:
+        yield(Regions([open_start], [offset-1]))
+
 #%% Convert to index
 def idx2region(data):
-    idxbin=np.arange(np.min(data), np.max(data)+1)
+    data=np.asarray(data)
+    # Sort and remove duplicates if required
+    if np.any(np.diff(data)<=0):
+        data=np.unique(data)
+
+    # A region stops where the next index is not consecutive
+    boundaries=np.flatnonzero(np.diff(data)!=1)
+    start=data[np.append(0, boundaries+1)]
+    stop=data[np.append(boundaries, len(data)-1)]
+    out=Regions(start,stop)
 
-    locbin=np.isin(idxbin,data).astype(int)
-    out=ones2region(locbin)
-    for i in range(0,len(out)):
-        out[i]=(idxbin[out[i][0]], idxbin[out[i][1]])
-        
     return(out)
 
 #%% Convert index to ones
 def region2ones(data):
-    out=np.zeros(np.max(data)+1).astype(int)
-    for i in range(0,len(data)):
-        out[np.arange(data[i][0],data[i][1]+1)]=1
+    data=Regions.from_list(data)
+    n=np.max(data.stop)+1
+
+    # Difference array: +1 at each start and -1 after each stop
+    boundaries=np.bincount(data.start, minlength=n+1) - np.bincount(data.stop+1, minlength=n+1)
+    out=(np.cumsum(boundaries)[:-1]>0).astype(int)
 
     return(out)
 
@@ -95,4 +240,236 @@ def region2idx(data):
 #%% Convert index to ones
 def ones2idx(data):
     out = np.where(data)[0]
-    return(out)
\ No newline at end of file
+    return(out)
+
+#%% Regions
+class Regions:
+    """Regions with start and stop (inclusive) indices, stored in two int64 arrays.
+
+    Parameters
+    ----------
+    start : array-like
+        Start indices.
+    stop : array-like
+        Stop indices (inclusive).
+
+    Examples
+    --------
+    >>> A = Regions([0,10],[5,20])
+    >>> A.union(Regions.from_list([(3,12)]))
+    Regions([(0, 20)])
+
+    """
+    def __init__(self, start=[], stop=[]):
+        self.start = np.asarray(start, dtype=np.int64).ravel()
+        self.stop = np.asarray(stop, dtype=np.int64).ravel()
+        assert len(self.start)==len(self.stop), 'Number of start and stop indices does not match'
+
+    @classmethod
+    def from_list(cls, data):
+        """Create Regions from a list of (start, stop) tuples, a (n,2) array or Regions."""
+        if isinstance(data, Regions):
+            return(data)
+        data = np.asarray(data, dtype=np.int64).reshape(-1,2)
+        return(cls(data[:,0], data[:,1]))
+
+    def __len__(self):
+        return(len(self.start))
+
+    def __iter__(self):
+        return(zip(self.start, self.stop))
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            return((self.start[i], self.stop[i]))
+        return(Regions(self.start[i], self.stop[i]))
+
+    def __eq__(self, other):
+        other = Regions.from_list(other)
+        return(np.array_equal(self.start, other.start) and np.array_equal(self.stop, other.stop))
+
+    def __repr__(self):
+        return('Regions(%s)' %(self.to_list()))
+
+    def to_list(self):
+        return(list(zip(self.start.tolist(), self.stop.tolist())))
+
+    def lengths(self):
+        """Number of indices in each region."""
+        return(self.stop - self.start + 1)
+
+    def merge(self, gap=0):
+        """Sort the regions and merge regions that overlap or that are separated by at most gap indices."""
+        if len(self)==0:
+            return(Regions())
+        order = np.argsort(self.start, kind='stable')
+        start = self.start[order]
+        stop = np.maximum.accumulate(self.stop[order])
+        # A new region begins if it starts after the furthest stop so far plus the gap
+        new = np.append(True, start[1:] > stop[:-1] + 1 + gap)
+        return(Regions(start[new], stop[np.append(np.flatnonzero(new)[1:]-1, len(stop)-1)]))
+
+    def union(self, other):
+        return(self._combine(other, lambda a, b: a | b))
+
+    def intersection(self, other):
+        return(self._combine(other, lambda a, b: a & b))
+
+    def difference(self, other):
+        return(self._combine(other, lambda a, b: a & ~b))
+
+    def complement(self, n=None):
+        """Regions in [0, n) that are not covered. By default n is the last stop + 1."""
+        n = (np.max(self.stop)+1 if len(self)>0 else 0) if n is None else n
+        return(Regions([0],[n-1]).difference(self) if n>0 else Regions())
+
+    def _combine(self, other, keep):
+        a = self.merge()
+        b = Regions.from_list(other).merge()
+        # Boundaries of all regions, stops are converted to exclusive
+        pos = np.concatenate([a.start, a.stop+1, b.start, b.stop+1])
+        if len(pos)==0:
+            return(Regions())
+        ones_a = np.concatenate([np.ones(len(a)), -np.ones(len(a)), np.zeros(2*len(b))])
+        ones_b = np.concatenate([np.zeros(2*len(a)), np.ones(len(b)), -np.ones(len(b))])
+        [pos, inverse] = np.unique(pos, return_inverse=True)
+        # Coverage of each segment [pos[k], pos[k+1])
+        in_a = np.cumsum(np.bincount(inverse, weights=ones_a, minlength=len(pos)))>0
+        in_b = np.cumsum(np.bincount(inverse, weights=ones_b, minlength=len(pos)))>0
+        boundaries = np.diff(np.concatenate([[0], keep(in_a, in_b).astype(np.int8), [0]]))
+        start = pos[np.flatnonzero(boundaries==1)]
+        stop = pos[np.flatnonzero(boundaries==-1)]-1
+        return(Regions(start, stop))
+
+#%% Index on regions
+class RegionIndex:
+    """Index for fast point and overlap queries on regions.
+
+    The regions are stored as a nested containment list: regions are sorted on start, and each region
+    is placed in the list of the nearest preceding region that contains it. Within a list the starts
+    and the stops both increase, thus the regions that overlap a query are one contiguous range that
+    is found with a binary search. Only lists of overlapping regions are visited, which makes
+    overlap() proportional to the number of returned pairs, also when regions are nested. The lists
+    are visited one nesting level at a time, so deeply nested regions (a chain of regions that each
+    contain the next) cost one iteration per level.
+
+    Parameters
+    ----------
+    regions : Regions, list of (start, stop) tuples or (n,2) array
+
+    Examples
+    --------
+    >>> index = RegionIndex(ones2region(data))
+    >>> region = index.find([3, 8])
+    >>> [query, region] = index.overlap([0, 5], [2, 10])
+
+    """
+    def __init__(self, regions):
+        regions = Regions.from_list(regions)
+        # Region numbers sorted on start, and on stop (descending) so that a region comes before the regions it contains
+        self.order = np.lexsort((-regions.stop, regions.start))
+        self.start = regions.start[self.order]
+        self.stop = regions.stop[self.order]
+        # The first region with a running maximum >= point is the region with the lowest start that can contain the point
+        self.max_stop = np.maximum.accumulate(self.stop) if len(self.stop)>0 else self.stop
+
+        # Parent of each region: the nearest preceding region that contains it, -1 for the top level.
+        # Candidates are skipped by pointer jumping: all regions between the candidate and the region stop earlier.
+        parent = np.arange(len(self.stop)) - 1
+        active = np.flatnonzero(parent>=0)
+        while len(active)>0:
+            active = active[self.stop[parent[active]] < self.stop[active]]
+            parent[active] = parent[parent[active]]
+            active = active[parent[active]>=0]
+
+        # Lists of the containment tree: regions with the same parent are contiguous in self.nclist
+        self.nclist = np.lexsort((np.arange(len(parent)), parent))
+        sorted_parent = parent[self.nclist]
+        nodes = np.arange(-1, len(parent))
+        self.list_lo = np.searchsorted(sorted_parent, nodes, side='left')
+        self.list_hi = np.searchsorted(sorted_parent, nodes, side='right')
+
+    def __len__(self):
+        return(len(self.start))
+
+    def find(self, points):
+        """Number of the region that contains each point, -1 if there is none.
+
+        For overlapping regions, the region with the lowest start is returned.
+        """
+        points = np.asarray(points, dtype=np.int64).ravel()
+        out = np.full(len(points), -1)
+        if len(self)==0:
+            return(out)
+
+        # First region that reaches the point, it contains the point if it starts before it
+        k = np.searchsorted(self.max_stop, points, side='left')
+        k_valid = np.minimum(k, len(self)-1)
+        I = (k<len(self)) & (self.start[k_valid]<=points)
+        out[I] = self.order[k_valid[I]]
+        return(out)
+
+    def overlap(self, a, b):
+        """All pairs of query and region number where the region overlaps [a, b].
+
+        Parameters
+        ----------
+        a : array-like
+            Start of the queries.
+        b : array-like
+            Stop (inclusive) of the queries.
+
+        Returns
+        -------
+        tuple (query, region)
+            Query and region numbers, grouped per query and sorted on the start of the regions.
+
+        """
+        a = np.asarray(a, dtype=np.int64).ravel()
+        b = np.asarray(b, dtype=np.int64).ravel()
+        if len(a)==0:
+            return(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        start = self.start[self.nclist]
+        stop = self.stop[self.nclist]
+        out_query = []
+        out_pos = []
+
+        # Start with the top level list for every query
+        query = np.arange(len(a))
+        lo = np.full(len(a), self.list_lo[0])
+        hi = np.full(len(a), self.list_hi[0])
+        while len(query)>0:
+            # Within a list, the overlapping regions are the range: stop >= a and start <= b
+            first = _searchsorted_ranges(stop, lo, hi, a[query], side='left')
+            last = _searchsorted_ranges(start, lo, hi, b[query], side='right')
+            counts = np.maximum(last-first, 0)
+            query = np.repeat(query, counts)
+            pos = np.repeat(first, counts) + np.arange(len(query)) - np.repeat(np.cumsum(counts)-counts, counts)
+            out_query.append(query)
+            out_pos.append(pos)
+            # Continue in the lists of the overlapping regions
+            node = self.nclist[pos] + 1
+            lo = self.list_lo[node]
+            hi = self.list_hi[node]
+            I = hi>lo
+            [query, lo, hi] = [query[I], lo[I], hi[I]]
+
+        query = np.concatenate(out_query)
+        region = self.nclist[np.concatenate(out_pos)]
+        order = np.lexsort((region, query))
+        return(query[order], self.order[region[order]])
+
+#%% Binary search of x in the sorted part values[lo:hi], for each query at once
+def _searchsorted_ranges(values, lo, hi, x, side='left'):
+    lo = lo.copy()
+    hi = hi.copy()
+    while np.any(lo<hi):
+        I = lo<hi
+        mid = (lo + hi)//2
+        if side=='left':
+            right = I & (values[np.minimum(mid, len(values)-1)] < x)
+        else:
+            right = I & (values[np.minimum(mid, len(values)-1)] <= x)
+        lo = np.where(right, mid+1, lo)
+        hi = np.where(I & ~right, mid, hi)
+    return(lo)
@@ -25,6 +25,32 @@
                    False: (default)
                    True
 
+   sample:         [int] Number of randomly sampled rows that is used to detect the dtypes.
+                   None (default: all rows)
+                   100000
+
+   confirm:        [Bool] Confirm the dtype on all rows when the sample is not decisive: a column that passes perc_min_num on the sample, or is
+                   less than 50% (relative) below it. The uniqueness of a sample is usually, but not always, higher than that of all rows.
+                   True (default)
+                   False
+
+   downcast:       [Bool] Store numerical ['num'] columns in the smallest dtype without loss of values (int8, uint8, int16, ..., float32), and print the memory usage before and after.
+                   Note that whole numbers are stored as integers.
+                   False (default)
+                   True
+
+   cache:          [Bool] Reuse the dtype of a column that was detected before with the same settings. A column is recognized on its name, dtype, length and the values on 64 fixed positions.
+                   False (default)
+                   True
+
+   cat_dtype:      [str] Dtype of the categorical ['cat'] columns.
+                   'str' (default): Python strings
+                   'category': pandas Categorical with the same (str) labels, which stores each label only once
+
+   inplace:        [Bool] Set the dtypes in df itself instead of in a copy of df.
+                   False (default)
+                   True
+
 
    verbose:        Integer [0..5] if verbose >= DEBUG: print('debug message')
                    0: (default)
@@ -44,6 +70,14 @@
    import etutils.set_dtypes as set_dtypes
 
    A = set_dtypes(df)
+   # Detect dtypes on 100000 rows of a large dataframe
+   A = set_dtypes(df, sample=100000)
+   # Categorical columns with low memory usage, without copying df
+   A = set_dtypes(df, cat_dtype='category', inplace=True)
+   # Numerical columns in the smallest dtype
+   A = set_dtypes(df, downcast=True, cat_dtype='category')
+   # Repeated calls on the same columns take the dtypes from the cache
+   A = set_dtypes(df, cache=True)
 
  -----------------------------------
   Name        : df2onehot.py
@@ -58,84 +92,169 @@ import pandas as pd
 import numpy as np
 from sklearn.preprocessing import LabelEncoder
 label_encoder = LabelEncoder()
+# Cache of detected dtypes, keyed on the column fingerprint
+CACHE_MAX_SIZE = 100000
+CACHE_SAMPLE_SIZE = 64
+# Relative margin below perc_min_num in which the uniqueness of a sample is confirmed on all rows
+SAMPLE_MARGIN = 0.5
+_DTYPES_CACHE = dict()
 
 #%% Set dtypes
-def set_dtypes(df, dtypes='pandas', is_list=False, perc_min_num=None, num_if_decimal=True, verbose=3):
+def set_dtypes(df, dtypes='pandas', is_list=False, perc_min_num=None, num_if_decimal=True, sample=None, confirm=True, cat_dtype='str', inplace=False, downcast=False, cache=False, verbose=3):
 	# DECLARATIONS
     config = dict()
     config['dtypes']  = dtypes
     config['is_list'] = is_list
     config['perc_min_num'] = perc_min_num
     config['num_if_decimal'] = num_if_decimal
+    config['sample'] = sample
+    config['confirm'] = confirm
+    config['cat_dtype'] = cat_dtype
+    config['inplace'] = inplace
+    config['downcast'] = downcast
+    config['cache'] = cache
     config['verbose'] = verbose
 
     # Determine dtypes for columns
-    config['dtypes'] = auto_dtypes(df, config['dtypes'], is_list=config['is_list'], perc_min_num=config['perc_min_num'], num_if_decimal=config['num_if_decimal'], verbose=config['verbose']) 
+    config['dtypes'] = auto_dtypes(df, config['dtypes'], is_list=config['is_list'], perc_min_num=config['perc_min_num'], num_if_decimal=config['num_if_decimal'], sample=config['sample'], confirm=config['confirm'], cache=config['cache'], verbose=config['verbose']) 
     # Setup dtypes in columns
-    df = set_types(df.copy(), config['dtypes'], verbose=config['verbose'])
+    if config['downcast'] and config['verbose']>=3: memory = df.memory_usage(deep=True).sum()
+    if not config['inplace']: df = df.copy()
+    df = set_types(df, config['dtypes'], cat_dtype=config['cat_dtype'], downcast=config['downcast'], verbose=config['verbose'])
+    if config['downcast'] and config['verbose']>=3: print('[DTYPES] Memory usage: %.1fMB -> %.1fMB' %(memory/1E6, df.memory_usage(deep=True).sum()/1E6))
 
     # return
     return(df, config['dtypes'])
 
 #%% Setup columns in correct dtypes
-def auto_dtypes(df, dtypes, is_list=False, perc_min_num=None, num_if_decimal=True, verbose=3):
+def auto_dtypes(df, dtypes, is_list=False, perc_min_num=None, num_if_decimal=True, sample=None, confirm=True, cache=False, verbose=3):
     #if 'str' in str(type(dtypes)):
     if isinstance(dtypes, str):
         if verbose>=3: print('[DTYPES] Auto detecting dtypes')
-        max_str_len=np.max(list(map(len, df.columns.values.astype(str).tolist())))
-        dtypes = ['']*df.shape[1]
-        logstr = '   '
-        
-        for i in range(0,df.shape[1]):
-            if 'float' in str(df.dtypes[i]):
-                dtypes[i]='num'
-                logstr = ('[float]')
-            elif 'int' in str(df.dtypes[i]):
-                #logstr = (' > [integer]: Set to categorical. Uniqueness=%.2f' %(df.iloc[:,i].unique().shape[0]/df.shape[0]))
-                dtypes[i]='cat'
-                logstr = ('[int]  ')
-            elif 'str' in str(df.dtypes[i]):
-                dtypes[i]='cat'
-                logstr = ('[str]  ')
-            elif 'object' in str(df.dtypes[i]):
-                # Check whether this is a list
-                logstr = ('[obj]  ')
-                if is_list:
-                    dtypes[i]='list' if isinstance(list(), type(df.iloc[:,i][0])) else 'cat'
-                else:
-                    dtypes[i]='cat' 
-            elif 'bool' in str(df.dtypes[i]):
-                dtypes[i]='cat'
-                logstr = ('[bool]  ')
-            else:
-                dtypes[i]='cat'
-                logstr = ('[???]  ')
-            
-            # Force numerical if unique elements are above percentage
-            if (perc_min_num!=None) and (('float' in str(df.dtypes[i])) or ('int' in str(df.dtypes[i]))):
-                tmpvalues=df.iloc[:,i].dropna().astype(float).copy()
-                #tmpvalues=tmpvalues[tmpvalues>0]
-                perc=(len(np.unique(tmpvalues))/len(tmpvalues))
-                if (perc>=perc_min_num):
-                    dtypes[i]='num'
-                    logstr = ('[force]')
-                    #logstr=' > [numerical]: Uniqueness %.2f>=%.2f' %((df.iloc[:,i].unique().shape[0]/df.shape[0]), perc_min_num)
-
-            # Force numerical if values are found with decimals
-            if num_if_decimal and (('float' in str(df.dtypes[i])) or ('int' in str(df.dtypes[i]))):
-                tmpvalues=df.iloc[:,i].dropna().copy()
-                if np.any(tmpvalues.astype(int)-tmpvalues.astype(float)>0):
-                    dtypes[i]='num'
-                    logstr = ('[force]')
-                    #logstr=' > [numerical]: Values show decimals.'
-            
-            makespaces=''.join([' ']*(max_str_len-len(df.columns[i])))
-            if verbose>=2: print('[DTYPES] [%s]%s > %s->[%s] [%.0d]' %(df.columns[i], makespaces, logstr, dtypes[i], len(df.iloc[:,i].dropna().unique())))
+        dtypes = np.full(df.shape[1], '', dtype=object)
+        logstr = np.full(df.shape[1], '', dtype=object)
+        nunique = np.full(df.shape[1], -1)
+
+        # Take the dtypes of columns that are seen before with the same settings
+        Icache = np.zeros(df.shape[1], dtype=bool)
+        if cache:
+            keys = [_fingerprint(df.iloc[:,i], (is_list, perc_min_num, num_if_decimal, sample, confirm)) for i in range(0,df.shape[1])]
+            Icache = np.array([key in _DTYPES_CACHE for key in keys], dtype=bool)
+            for i in np.flatnonzero(Icache):
+                [dtypes[i], logstr[i], nunique[i]] = _DTYPES_CACHE[keys[i]]
+            if verbose>=3 and np.any(Icache): print('[DTYPES] Dtypes of %d columns are taken from the cache' %(np.sum(Icache)))
+
+        # Detect the dtypes of the remaining columns
+        idx = np.flatnonzero(~Icache)
+        if len(idx)>0:
+            df_detect = df if len(idx)==df.shape[1] else df.iloc[:,idx]
+            # Rows that are used to detect the dtypes
+            df_sample = _sample_rows(df_detect, sample)
+            if (verbose>=3) and (df_sample.shape[0]<df.shape[0]): print('[DTYPES] Detect dtypes on a sample of %d rows' %(df_sample.shape[0]))
+            [dtypes[idx], logstr[idx]] = _detect_dtypes(df_detect, df_sample, is_list=is_list, perc_min_num=perc_min_num, num_if_decimal=num_if_decimal, confirm=confirm)
+            if verbose>=2: nunique[idx] = _nunique(df_sample, dtypes[idx])
+            if cache:
+                for i in idx: _DTYPES_CACHE[keys[i]] = (dtypes[i], logstr[i], nunique[i])
+                for key in list(_DTYPES_CACHE.keys())[:max(0, len(_DTYPES_CACHE)-CACHE_MAX_SIZE)]: _DTYPES_CACHE.pop(key)
+
+        if verbose>=2:
+            max_str_len=np.max(list(map(len, df.columns.values.astype(str).tolist())))
+            # Columns from the cache that were stored without a count
+            Icount = nunique<0
+            if np.any(Icount):
+                nunique[Icount] = _nunique(_sample_rows(df.iloc[:,Icount], sample), dtypes[Icount])
+                if cache:
+                    for i in np.flatnonzero(Icount): _DTYPES_CACHE[keys[i]] = (dtypes[i], logstr[i], nunique[i])
+            for i in range(0,df.shape[1]):
+                makespaces=''.join([' ']*(max_str_len-len(df.columns[i])))
+                print('[DTYPES] [%s]%s > %s->[%s] [%.0d]' %(df.columns[i], makespaces, logstr[i], dtypes[i], nunique[i]))
+        dtypes = dtypes.tolist()
     
     return(dtypes)
 
+#%% Detect the dtypes of all columns at once
+def _detect_dtypes(df, df_sample, is_list=False, perc_min_num=None, num_if_decimal=True, confirm=True):
+    # Classify all columns at once on the names of their dtypes
+    names = df.dtypes.astype(str).values.astype(str)
+    logstr = np.full(df.shape[1], '[???]  ', dtype=object)
+    Iremain = np.ones(df.shape[1], dtype=bool)
+    for name, log in [('float','[float]'), ('int','[int]  '), ('str','[str]  '), ('object','[obj]  '), ('bool','[bool]  ')]:
+        I = Iremain & (np.char.find(names, name)>=0)
+        logstr[I] = log
+        Iremain = Iremain & ~I
+    dtypes = np.where(logstr=='[float]', 'num', 'cat').astype(object)
+    Iint = logstr=='[int]  '
+
+    # Check whether an object column is a list. This is the only check per column.
+    if is_list:
+        for i in np.flatnonzero(logstr=='[obj]  '):
+            dtypes[i]='list' if isinstance(list(), type(df.iloc[:,i][0])) else 'cat'
+
+    # Force numerical if unique elements are above percentage.
+    # The uniqueness of a sample is usually higher than that of all rows, but it can be lower. Columns that pass on the sample, or
+    # that are less than SAMPLE_MARGIN (relative) below perc_min_num, are ambiguous and confirmed on all rows.
+    if (perc_min_num!=None) and np.any(Iint):
+        idx = np.flatnonzero(Iint)
+        perc = _perc_unique(df_sample.iloc[:,idx])
+        if confirm and (df_sample.shape[0]<df.shape[0]):
+            idx = idx[perc>=perc_min_num*(1-SAMPLE_MARGIN)]
+            if len(idx)>0: idx = idx[_perc_unique(df.iloc[:,idx])>=perc_min_num]
+        else:
+            idx = idx[perc>=perc_min_num]
+        dtypes[idx]='num'
+        logstr[idx]='[force]'
+        #logstr=' > [numerical]: Uniqueness %.2f>=%.2f' %((df.iloc[:,i].unique().shape[0]/df.shape[0]), perc_min_num)
+
+    # Force numerical if values are found with decimals. Float columns are numerical already and integers can not contain decimals.
+    Idec = Iint & (dtypes!='num') & ~np.isin([dtype.kind for dtype in df.dtypes], ['i','u'])
+    if num_if_decimal and np.any(Idec):
+        idx = np.flatnonzero(Idec)
+        idx = idx[_has_decimals(df_sample.iloc[:,idx])]
+        dtypes[idx]='num'
+        logstr[idx]='[force]'
+        #logstr=' > [numerical]: Values show decimals.'
+
+    return(dtypes, logstr)
+
+#%% Fingerprint of a column: name, dtype, length and the values on fixed positions
+def _fingerprint(values, settings):
+    idx = np.unique(np.linspace(0, len(values)-1, min(len(values), CACHE_SAMPLE_SIZE)).astype(int))
+    return((str(values.name), str(values.dtype), len(values), tuple(values.iloc[idx].astype(str).tolist()), settings))
+
+#%% Remove all dtypes from the cache
+def clear_cache():
+    _DTYPES_CACHE.clear()
+
+#%% Number of unique values per column
+def _nunique(df, dtypes):
+    # Lists are not hashable, these are counted on their string representation
+    Ilist = dtypes=='list'
+    nunique = np.zeros(df.shape[1], dtype=int)
+    nunique[~Ilist] = df.loc[:,~Ilist].nunique().values
+    nunique[Ilist] = df.loc[:,Ilist].astype(str).nunique().values
+    return(nunique)
+
+#%% Random sample of rows, in the original order
+def _sample_rows(df, sample=None):
+    if (sample is None) or (sample>=df.shape[0]):
+        return(df)
+    idx = np.random.default_rng(0).choice(df.shape[0], size=sample, replace=False)
+    return(df.iloc[np.sort(idx),:])
+
+#%% Fraction of unique values of each column, of the non-missing values
+def _perc_unique(df):
+    return((df.nunique().values/np.maximum(df.count().values, 1)))
+
+#%% Columns with one or more decimal values, on the 2-D block of values
+def _has_decimals(df):
+    out = np.zeros(df.shape[1], dtype=bool)
+    step = max(1, 2**24//max(1, df.shape[0]))
+    for i in range(0, df.shape[1], step):
+        out[i:i+step] = np.any(np.modf(df.iloc[:,i:i+step].to_numpy(dtype=float))[0]!=0, axis=0)
+    return(out)
+
 #%% Setup columns in correct dtypes
-def set_types(df, dtypes, verbose=3):
+def set_types(df, dtypes, cat_dtype='str', downcast=False, verbose=3):
     assert len(dtypes)==df.shape[1], 'Number of dtypes and columns in df does not match'
 
     if verbose>=3: print('[DTYPES] Setting dtypes in dataframe')
@@ -144,15 +263,45 @@ def set_types(df, dtypes, verbose=3):
         if verbose>=4: print('[DTYPES] %s' %(col))
         if dtype=='num':
             df[col]=df[col].astype(float)
+            if downcast: df[col] = _downcast(df[col])
         elif dtype=='cat':
             df[col].loc[df[col].isna().values]=None
-            df[col] = df[col].astype(str)
-            # df[col] = df[col].astype('category')
+            if cat_dtype=='category':
+                df[col] = _set_category(df[col])
+            else:
+                df[col] = df[col].astype(str)
         else:
             if verbose>=2: print('[DTYPES] [%s] [list] is used in dtyping!' %(col))
 
     return(df)
 
+#%% Smallest numeric dtype that holds all values without loss: an integer type if all values are whole numbers, else float32 or float64
+def _downcast(values):
+    arr = values.values
+    if (len(arr)>0) and np.all(np.isfinite(arr)) and np.all(np.modf(arr)[0]==0) and (np.max(np.abs(arr))<2**53):
+        for dtype in [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.uint64, np.int64]:
+            if (np.iinfo(dtype).min<=np.min(arr)) and (np.max(arr)<=np.iinfo(dtype).max):
+                return(values.astype(dtype))
+    if np.array_equal(arr.astype(np.float32), arr, equal_nan=True):
+        return(values.astype(np.float32))
+    return(values)
+
+#%% Categorical column with the same labels as astype(str), but each label is stored once
+def _set_category(values):
+    # Label of the missing values: the label that astype(str) gives them ('None', 'nan', '<NA>', ...)
+    isna = values.isna().values
+    missing = values[isna].iloc[:1].astype(str).iloc[0] if np.any(isna) else None
+    categories = values if values.dtype=='category' else values.astype('category')
+    labels = categories.cat.categories.astype(str)
+    # Different values with the same label (such as 1 and '1') can not be renamed, the labels are taken from the original values
+    if labels.has_duplicates:
+        return(values.astype(str).astype('category').cat.reorder_categories(np.sort(values.astype(str).unique())))
+    values = categories.cat.rename_categories(labels)
+    if np.any(isna):
+        if missing not in values.cat.categories: values = values.cat.add_categories([missing])
+        values = values.fillna(missing)
+    return(values.cat.reorder_categories(np.sort(values.cat.categories.values)))
+
 #%% Set y
 def set_y(y, y_min=None, numeric=False, verbose=3):
     y = y.astype(str)
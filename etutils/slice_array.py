@@ -5,4 +5,9 @@ def slice_array(arr, size):
          arrs.append(pice)
          arr   = arr[size:]
      arrs.append(arr)
-     return arrs
\ No newline at end of file
+     return arrs
+
+#%% Slice array in chunks along the first axis. Slices of arrays and memmaps are views, no data is copied.
+def slice_chunks(data, chunksize):
+     for i in range(0, data.shape[0], chunksize):
+         yield(data[i:i+chunksize])